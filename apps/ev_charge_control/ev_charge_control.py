@@ -58,8 +58,13 @@ VERSION = "0.54.3"
 # Store all attributes every day to disk
 STORE_TO_FILE_EVERY = 60 * 60 * 24
 
+# Delay before writing changed attributes to disk, so that a burst
+# of changes only results in one write
+DELAY_BEFORE_SAVE = 0.5
+
 DELAY_AFTER_STATE_CHANGE = 5.0
-MAX_TIME_FOR_WORKER_TO_SLEEP = 3600  # 1 hour
+MAX_TIME_FOR_WORKER_TO_SLEEP = 3600  # 1 hour, used when no price info
+WAKE_UP_AFTER_SLOT_END = 1  # Make sure the slot has ended when we wake up
 RETRY_AFTER_FAILURE = 60  # 1 minute
 
 ENTITIES = {
@@ -85,16 +90,61 @@ ENTITIES = {
         },
     },
 }
+
+# Status attributes used when there is no charging schedule. The slots list
+# is shared, so it must never be modified in place
+NO_SCHEDULE = {
+    "next_start": "",
+    "next_stop": "",
+    "slots": [],
+}
+
+# Status attributes that are cleared at the start of every calculation
+RESET_BEFORE_CALCULATION = {
+    "next_start": None,
+    "next_stop": None,
+    "slots": None,
+    "charge_time_left": None,
+}
+
 import appdaemon.plugins.hass.hassapi as hass
-import copy
+import heapq
 import json
-import queue
 
+from collections import namedtuple
 from datetime import datetime
 from datetime import timedelta
 from datetime import time
 from dateutil import parser
-from dateutil import tz
+from functools import lru_cache
+from itertools import chain
+from operator import itemgetter
+from pathlib import Path
+
+# Use the faster orjson for the persistance file if it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Directory of this app, where the persistance files are stored
+APP_DIR = Path(__file__).parent
+
+# A price slot that can be used for charging. start and end are datetimes,
+# the other times are in seconds relative to midnight or now
+PriceSlot = namedtuple(
+    "PriceSlot",
+    [
+        "start",
+        "end",
+        "start_from_midnight",
+        "end_from_midnight",
+        "length",
+        "seconds_until_start",
+        "price",
+    ],
+)
+
 
 class SmartCharging(hass.Hass):
 
@@ -102,25 +152,39 @@ class SmartCharging(hass.Hass):
     home_tag = "home"
 
     def initialize(self):
+        self.main_log = self.get_main_log()
+
         if "debug" in self.args and self.args["debug"]:
             self.set_log_level("DEBUG")
 
         self.log("Starting....")
 
-        self.debug(f"App pin state: {self.get_app_pin()}")
-        self.debug(f"Current thread: {self.get_pin_thread()}")
-        self.event_listeners = []
+        self.debug("App pin state: %s", self.get_app_pin())
+        self.debug("Current thread: %s", self.get_pin_thread())
+
+        # Entities created by this app
+        self.active_entity_id = f"switch.{self.name}_active"
+        self.status_entity_id = f"sensor.{self.name}_status"
+        self.switch_prefix = f"switch.{self.name}"
 
         self.status_state = "unknown"
-        self.status_attributes = copy.deepcopy(
-            ENTITIES["~_status"]["attributes"]
-        )
+        # slots is the only mutable value, so it is the only one that needs
+        # a fresh object
+        self.status_attributes = {
+            **ENTITIES["~_status"]["attributes"],
+            "slots": [],
+        }
+
+        # What was last sent to the status entity
+        self.last_status = None
 
         # This is the file where we store current states
         # between restarts for this app
-        self.persistance_file = (
-            __file__.rsplit("/", 1)[0] + f"/{self.name}.json"
-        )
+        self.persistance_file = APP_DIR / f"{self.name}.json"
+
+        # Keys in self.data that have changed since last written to file
+        self.dirty_keys = set()
+        self.save_handle = None
 
         self.load_persistance_file()
 
@@ -129,6 +193,19 @@ class SmartCharging(hass.Hass):
         self.run_calculations_handle = None
         self.charge_time_needed = None
 
+        # Parsed price info and the last_updated of the price entities
+        # it was parsed from
+        self.price_cache_key = None
+        self.price_cache = None
+
+        # Config values that refer to an entity, all other config values are
+        # literal values that are used as they are
+        self.config_entities = {
+            param: value
+            for param, value in self.args.items()
+            if self.is_entity(value)
+        }
+
         self.status_complete = self.get_config_value(
             "charging_state_complete", "complete"
         ).lower()
@@ -141,19 +218,49 @@ class SmartCharging(hass.Hass):
 
         self.time_when_charging_started = self.datetime(aware=True)
 
-        self.setup_listener("switch." + self.name + "_active")
+        self.charger_switch, _ = self.get_entity_and_attribute(
+            self.args["charger_switch"]
+        )
+
+        # State we have switched the charger to but not yet seen change
+        self.expected_charger_state = None
+
+        # Entities that need special handling when they change, all other
+        # entities are handled by handle_entity_change
+        finish_by, _ = self.get_entity_and_attribute(
+            self.args["finish_at_latest_by"]
+        )
+
+        self.state_handlers = {
+            self.active_entity_id: self.handle_active_change,
+            self.charger_switch: self.handle_charger_switch_change,
+            finish_by: self.handle_finish_by_change,
+        }
+
+        # finish_at_latest_by in seconds from midnight, read when needed and
+        # kept until the entity holding it changes
+        self.finish_by_seconds = None
+
+        self.setup_listener(self.active_entity_id)
         self.setup_listener(self.args["finish_at_latest_by"])
         self.setup_listener(self.args["charger_switch"])
         self.setup_listener(self.args["charging_state"])
         self.setup_listener(self.args["device_tracker"])
         self.setup_listener(self.args["time_left"])
 
+        # Entity, attribute and if it is required for each price_data entry
+        self.price_entities = []
+
         for pd in self.args["price_data"]:
             self.setup_listener(pd["entity"])
 
+            e, a = self.get_entity_and_attribute(pd["entity"])
+            required = "required" in pd and bool(pd["required"])
+            self.price_entities.append((e, a, required))
+
         if "device_tracker_value_home" in self.args:
             self.home_tag = self.args["device_tracker_value_home"]
-            self.debug(f"Setting home tag to: {self.home_tag}")
+            self.debug("Setting home tag to: %s", self.home_tag)
 
         # Save the current state of all covers every STORE_COVER_STATE_EVERY
         # seconds
@@ -168,13 +275,16 @@ class SmartCharging(hass.Hass):
 
     def terminate(self):
         self.debug("Will terminate...")
+
+        # Make sure pending changes are written before we go away
+        self.remove_timer(self.save_handle)
         self.save_persistance_file()
 
-        self.abort = True
+        # No more calculations should be started
+        self.remove_timer(self.run_calculations_handle)
 
-        # Remove all event listeners
-        for l in self.event_listeners:
-            self.cancel_listen_event(l)
+        # Our state and event listeners are removed by AppDaemon when the app
+        # is terminated, no need to cancel them one by one
 
         self.debug("Finished clean up process, bye bye...")
 
@@ -182,15 +292,18 @@ class SmartCharging(hass.Hass):
         """Load persistance data from file when app starts
         and initialize mandatory data if it doenst exist."""
         try:
-            with open(self.persistance_file, "r") as f:
-                self.data = json.load(f)
+            if orjson is not None:
+                self.data = orjson.loads(self.persistance_file.read_bytes())
+            else:
+                with self.persistance_file.open("r") as f:
+                    self.data = json.load(f)
 
         except IOError as e:
             self.log(f"Persistance file {self.persistance_file} not found...")
             self.data = {}
 
         except Exception as e:
-            self.get_main_log().exception(
+            self.main_log.exception(
                 "Unexpected exception when loading persistance file..."
             )
             self.data = {}
@@ -198,23 +311,56 @@ class SmartCharging(hass.Hass):
         for k, v in ENTITIES.items():
             if k not in self.data:
                 self.data[k] = v["state"]
+                self.dirty_keys.add(k)
 
     def save_persistance_file(self, kwargs=None):
-        """Save persistance data to file"""
+        """Save persistance data to file if anything has changed
+
+        The data is written to a temporary file that is then renamed over
+        the old one, so a crash during the write never leaves a truncated
+        persistance file behind."""
+        if not self.dirty_keys:
+            self.debug("No persistance entries changed, skipping write")
+            return
+
+        tmp_file = self.persistance_file.with_suffix(".json.tmp")
         try:
-            with open(self.persistance_file, "w") as f:
-                f.write(json.dumps(self.data, indent=4))
+            if orjson is not None:
+                tmp_file.write_bytes(orjson.dumps(self.data))
+            else:
+                with tmp_file.open("w") as f:
+                    json.dump(self.data, f, separators=(",", ":"))
+
+            tmp_file.replace(self.persistance_file)
+            self.dirty_keys.clear()
 
             self.log(f"Persistance entries written to {self.persistance_file}")
 
         except Exception as e:
-            self.get_main_log().exception(
+            self.main_log.exception(
                 "Unexpected exception when storing persistence file..."
             )
             return False
 
-    def debug(self, text):
-        self.get_main_log().debug(text)
+    def mark_dirty(self, key):
+        """Mark a persistance entry as changed and schedule a delayed save
+
+        Parameters
+        ----------
+        key : str
+            Key in self.data that has changed
+        """
+        self.dirty_keys.add(key)
+
+        self.remove_timer(self.save_handle)
+        self.save_handle = self.run_in(
+            self.save_persistance_file, DELAY_BEFORE_SAVE
+        )
+
+    def debug(self, msg, *args):
+        """Log a debug message. Arguments are only formatted into msg, using
+        %-style formatting, when debug logging is enabled."""
+        self.main_log.debug(msg, *args)
 
     def remove_timer(self, th):
         """Wrapper to cancel_timer with sanity checks
@@ -226,43 +372,88 @@ class SmartCharging(hass.Hass):
         """
         if th is not None and self.timer_running(th):
             self.cancel_timer(th)
-            self.debug(f"Cancelled the timer with handle: {th}")
+            self.debug("Cancelled the timer with handle: %s", th)
 
-    def get_friendly_date(self, in_date):
-        today = self.datetime(aware=True).date().today()
+    def get_friendly_date(self, in_date, today):
         tomorrow = today + timedelta(days=1)
         i = in_date.date()
 
         return "Today" if i == today else "Tomorrow" if i == tomorrow else i
 
+    def get_friendly_time(self, in_date, today):
+        """Format a datetime as e.g. 'Today at 07:30'
+
+        Parameters
+        ----------
+        in_date : datetime
+            Date and time to format
+        today : date
+            Today's date, passed in so it is only looked up once per run
+        """
+        friendly_date = self.get_friendly_date(in_date, today)
+
+        return f"{friendly_date} at {in_date.hour:02}:{in_date.minute:02}"
+
     def initialize_entities(self):
         self.debug("Setting up entities")
 
         for k, v in ENTITIES.items():
             entity_id = v["type"] + "." + k.replace("~", self.name)
-            self.debug(f"Will setup entity: {entity_id} -> {v}")
+            self.debug("Will setup entity: %s -> %s", entity_id, v)
 
-            self.set_state(
-                entity_id=entity_id,
-                state=self.data[k],
-                attributes=v["attributes"],
-            )
-            self.debug(f"Created entity {entity_id}")
+            # The entity is usually still there from before a restart of
+            # the app, so only set it when it differs
+            existing = self.get_state(entity_id=entity_id, attribute="all")
+
+            if (
+                existing is not None
+                and existing.get("state") == self.data[k]
+                and existing.get("attributes") == v["attributes"]
+            ):
+                self.debug("Entity %s is already up to date", entity_id)
+            else:
+                self.set_state(
+                    entity_id=entity_id,
+                    state=self.data[k],
+                    attributes=v["attributes"],
+                )
+                self.debug("Created entity %s", entity_id)
 
             if v["type"] == "switch":
-                self.event_listeners.append(
-                    self.listen_event(
-                        self.handle_incoming_event,
-                        "call_service",
-                        entity_id=entity_id,
-                        domain="switch",
-                    )
+                self.listen_event(
+                    self.handle_incoming_event,
+                    "call_service",
+                    entity_id=entity_id,
+                    domain="switch",
                 )
-                self.debug(f"Registered service call handler for {entity_id}")
+                self.debug("Registered service call handler for %s", entity_id)
+
+    def get_entity_value_and_last_changed(self, entity):
+        """Get the value of an entity and when it last changed with a
+        single state lookup
+
+        Parameters
+        ----------
+        entity : str
+            entity_id[,attribute] to get the value from
 
-    def get_entity_last_changed(self, entity):
+        Returns
+        -------
+        tuple
+            (value, last_changed) or (None, None) if the entity is missing
+        """
         e, a = self.get_entity_and_attribute(entity)
-        return self.get_state(entity_id=e, attribute="last_changed")
+        state = self.get_state(entity_id=e, attribute="all")
+
+        if state is None:
+            return None, None
+
+        if a is None:
+            value = state["state"]
+        else:
+            value = state["attributes"].get(a)
+
+        return value, state["last_changed"]
 
     def get_entity_value(self, entity):
         e, a = self.get_entity_and_attribute(entity)
@@ -270,12 +461,12 @@ class SmartCharging(hass.Hass):
         return self.get_state(entity_id=e, attribute=a)
 
     def setup_listener(self, entity):
-        e, a = self.get_entity_and_attribute(entity)
-
-        if e is None:
-            self.debug(f"{entity} is not an entity, skipping listen_state")
+        if not self.is_entity(entity):
+            self.debug("%s is not an entity, skipping listen_state", entity)
             return
 
+        e, a = self.get_entity_and_attribute(entity)
+
         self.log(f"Setting up listener for entity: {e}, attriute: {a}")
         self.listen_state(callback=self.new_state, entity_id=e, attribute=a)
 
@@ -297,7 +488,14 @@ class SmartCharging(hass.Hass):
                         isinstance(entity_id, list)
                         and kwargs["entity_id"] in entity_id
                     ):
-                        key = entity_id.replace("switch." + self.name, "~")
+                        # The switch this handler was registered for, which
+                        # also works when a list of entities was called
+                        switch = kwargs["entity_id"]
+
+                        if switch.startswith(self.switch_prefix):
+                            key = "~" + switch[len(self.switch_prefix) :]
+                        else:
+                            key = None
 
                         if key in self.data:
                             # When we set the state, self.new_state will be
@@ -309,51 +507,89 @@ class SmartCharging(hass.Hass):
                                 attributes=ENTITIES[key]["attributes"],
                             )
         except Exception as e:
-            self.get_main_log().exception(f"Exception when handling event")
+            self.main_log.exception(f"Exception when handling event")
 
     def new_state(self, entity, attribute, old, new, kwargs):
-        self.debug(f"NEW STATE!! {entity}.{attribute} = {new} ({old})")
+        self.debug("NEW STATE!! %s.%s = %s (%s)", entity, attribute, new, old)
 
-        run_after = DELAY_AFTER_STATE_CHANGE
+        handler = self.state_handlers.get(entity, self.handle_entity_change)
+        run_after = handler(old, new)
 
-        if entity.endswith(self.name + "_active"):
-            self.data["~_active"] = new
-            if new == "off":
-                self.debug("Trigger Calculations Immedietly...")
-                run_after = 0
+        if run_after is not None:
+            self.schedule_worker(run_after)
+
+    def handle_entity_change(self, old, new):
+        """Handle a change of an entity used in the calculations
 
+        Returns
+        -------
+        float
+            Seconds to wait before calculating, or None to not calculate
+        """
         # Delay trigger to avoid multiple calculations when multiple entities
         # change at the same time
-        self.schedule_worker(run_after)
+        return DELAY_AFTER_STATE_CHANGE
+
+    def handle_active_change(self, old, new):
+        if self.data["~_active"] != new:
+            self.data["~_active"] = new
+            self.mark_dirty("~_active")
+
+        if new == "off":
+            self.debug("Trigger Calculations Immedietly...")
+            return 0
+
+        return DELAY_AFTER_STATE_CHANGE
+
+    def handle_charger_switch_change(self, old, new):
+        # Only the first change after our own call can be caused by us. If
+        # the charger never reached the expected state, any later change
+        # must still trigger a calculation.
+        expected = self.expected_charger_state
+        self.expected_charger_state = None
+
+        if new == expected:
+            # We changed the charger ourselves, nothing new to calculate
+            self.debug("Charger switched by us, skipping calculations...")
+            return None
+
+        return DELAY_AFTER_STATE_CHANGE
+
+    def handle_finish_by_change(self, old, new):
+        # Read the new time on the next calculation
+        self.finish_by_seconds = None
+
+        return DELAY_AFTER_STATE_CHANGE
 
     def schedule_worker(self, delay):
         self.remove_timer(self.run_calculations_handle)
 
-        self.debug(f"Scheduling Calculations to run after {delay} seconds...")
+        self.debug("Scheduling Calculations to run after %s seconds...", delay)
         self.run_calculations_handle = self.run_in(self.worker, delay)
 
     def worker(self, kwargs):
-        self.debug(f"Current thread: {self.get_pin_thread()}")
+        self.debug("Current thread: %s", self.get_pin_thread())
+
+        # Use the same time for everything in this run. Just to make sure we
+        # can't get a negative number we store the time before creating the
+        # price list
+        now = self.datetime(aware=True)
+        self.debug("worker: now is: %s", now)
 
         try:
             self.debug("worker: Starting calculation...")
-            retry = not self.calculate()
+            retry = not self.calculate(now)
         except Exception as e:
-            self.get_main_log().exception("Unexpected exception...")
+            self.main_log.exception("Unexpected exception...")
             retry = True
 
-        # Just to make sure we can't get a negative number
-        # we store the time before creating the price list
-        now = self.datetime(aware=True)
-
-        self.debug(f"worker: now is: {now}")
-        price = self.get_price()
+        price = self.get_price(now)
 
         if price is not None and len(price):
-            sleep_time = (price[0]["end"] - now).total_seconds()
-
-            if sleep_time > MAX_TIME_FOR_WORKER_TO_SLEEP:
-                sleep_time = MAX_TIME_FOR_WORKER_TO_SLEEP
+            # Nothing will change until the current slot ends, unless one of
+            # the entities we listen to change, which triggers a new run
+            sleep_time = price[0].end.timestamp() - now.timestamp()
+            sleep_time += WAKE_UP_AFTER_SLOT_END
         else:
             sleep_time = MAX_TIME_FOR_WORKER_TO_SLEEP
 
@@ -366,19 +602,17 @@ class SmartCharging(hass.Hass):
             f"worker: Done for now. Will run again in {sleep_time} seconds..."
         )
 
-    def calculate(self):
+    def calculate(self, now):
         self.debug("Time to calculate...")
-        nowstr = self.datetime(aware=True).strftime("%H:%M")
+        nowstr = now.strftime("%H:%M")
 
-        self.debug(f"nowstr: {nowstr}")
+        self.debug("nowstr: %s", nowstr)
 
-        self.status_attributes["last_calculation"] = nowstr
-        self.status_attributes["next_start"] = None
-        self.status_attributes["next_stop"] = None
-        self.status_attributes["slots"] = None
-        self.status_attributes["charge_time_left"] = None
+        self.status_attributes.update(
+            RESET_BEFORE_CALCULATION, last_calculation=nowstr
+        )
 
-        self.debug(f"status: {self.status_attributes}")
+        self.debug("status: %s", self.status_attributes)
 
         if self.data["~_active"] == "off":
             self.debug("Module is inactivated by user...")
@@ -401,8 +635,10 @@ class SmartCharging(hass.Hass):
             return True
 
         self.debug("Trying to get current charging state...")
-        cs = self.get_entity_value(self.args["charging_state"])
-        self.debug(f"cs: {cs}")
+        cs, cs_lc = self.get_entity_value_and_last_changed(
+            self.args["charging_state"]
+        )
+        self.debug("cs: %s", cs)
         if cs is None:
             self.debug("Unable to read charging state...")
             self.error(f"Unable to read entity {self.args['charging_state']}")
@@ -413,18 +649,18 @@ class SmartCharging(hass.Hass):
             return True
 
         cs = cs.lower()
-        cs_lc = self.get_entity_last_changed(self.args["charging_state"])
 
-        tl = self.get_entity_value(self.args["time_left"])
-        tl_lc = self.get_entity_last_changed(self.args["time_left"])
+        tl, tl_lc = self.get_entity_value_and_last_changed(
+            self.args["time_left"]
+        )
 
-        self.debug(f"========== cs_lc: {cs_lc} ---- tl_lc: {tl_lc}")
+        self.debug("========== cs_lc: %s ---- tl_lc: %s", cs_lc, tl_lc)
 
-        time_diff = parser.parse(cs_lc) - parser.parse(tl_lc)
+        time_diff = self.parse_datetime(cs_lc) - self.parse_datetime(tl_lc)
 
-        self.debug(f"========== time_diff: {time_diff}")
+        self.debug("========== time_diff: %s", time_diff)
 
-        self.debug(f"Current state is: {cs}, time left: {tl}")
+        self.debug("Current state is: %s, time left: %s", cs, tl)
 
         if cs == self.status_charging:
             if tl > 0 and time_diff.total_seconds() < 0:
@@ -454,49 +690,65 @@ class SmartCharging(hass.Hass):
         else:
             self.status_attributes["charge_time_left"] = "unknown"
 
-        return self.start_stop_charging()
+        return self.start_stop_charging(now)
 
     def format_time(self, seconds):
-        h = int(seconds / 3600)
-        m = int(seconds / 60 - h * 60)
+        h, m = divmod(max(0, int(seconds)) // 60, 60)
 
         return f"{h:02}:{m:02}"
 
-    def start_charging(self):
-        try:
-            self.call_service(
-                "homeassistant/turn_on", entity_id=self.args["charger_switch"]
-            )
-            return True
+    def switch_charger(self, state):
+        """Turn the charger on or off
 
-        except Exception as e:
-            self.get_main_log().exception(
-                "Unexpected exception when calling service..."
-            )
-            return False
+        The service is always called, even if the switch already shows the
+        state, since re-sending the command is sometimes needed to make the
+        car act on it. If the switch will change, the new state is
+        remembered, so the resulting state change doesn't trigger a new
+        calculation.
 
-    def stop_charging(self):
+        Parameters
+        ----------
+        state : str
+            State to switch the charger to (on | off)
+
+        Returns
+        -------
+        bool
+            False if we failed to communicate with the charger
+        """
         try:
+            if self.get_state(entity_id=self.charger_switch) != state:
+                self.expected_charger_state = state
+            else:
+                # No state change will follow, so don't expect one
+                self.expected_charger_state = None
+
             self.call_service(
-                "homeassistant/turn_off", entity_id=self.args["charger_switch"]
+                f"homeassistant/turn_{state}",
+                entity_id=self.args["charger_switch"],
             )
             return True
 
         except Exception as e:
-            self.get_main_log().exception(
+            self.expected_charger_state = None
+            self.main_log.exception(
                 "Unexpected exception when calling service..."
             )
             return False
 
-    def start_stop_charging(self):
+    def start_charging(self):
+        return self.switch_charger("on")
+
+    def stop_charging(self):
+        return self.switch_charger("off")
+
+    def start_stop_charging(self, now):
         self.debug("Entering start_stop_charging...")
 
         if self.charge_time_needed is None:
             self.log("Starting to charge to calculate time needed")
+            self.status_attributes.update(NO_SCHEDULE)
             self.status_attributes["charge_time_left"] = "unknown"
-            self.status_attributes["next_start"] = ""
-            self.status_attributes["next_stop"] = ""
-            self.status_attributes["slots"] = []
 
             if not self.start_charging():
                 self.status_state = "error"
@@ -511,12 +763,10 @@ class SmartCharging(hass.Hass):
                 self.update_status_entity()
                 return True
 
-        price = self.get_price()
+        price = self.get_price(now)
         if price is None:
             self.log("We don't have required prices, aborting...")
-            self.status_attributes["next_start"] = ""
-            self.status_attributes["next_stop"] = ""
-            self.status_attributes["slots"] = []
+            self.status_attributes.update(NO_SCHEDULE)
 
             if not self.stop_charging():
                 self.status_state = "error"
@@ -531,80 +781,69 @@ class SmartCharging(hass.Hass):
                 self.update_status_entity()
                 return True
 
-        self.debug(f"We need {self.charge_time_needed} seconds to charge")
+        self.debug("We need %s seconds to charge", self.charge_time_needed)
 
         current_slot = price[0]
-        price = sorted(price, key=lambda i: i["price"])
 
-        self.debug(f"Valid prices: {len(price)}")
+        self.debug("Valid prices: %s", len(price))
 
-        # Find cheapest slots
-        slots = []
+        # Find cheapest slots. Only a few of them are usually needed, so
+        # keep them in a heap and stop as soon as we have enough time to
+        # charge. The index breaks ties in time order, as price is sorted
+        # by start time.
+        cheapest = [(p.price, i) for i, p in enumerate(price)]
+        heapq.heapify(cheapest)
+
+        selected = []
         length = 0
-        for p in price:
-            slots.append(p)
-            length += p["length"]
+        while cheapest:
+            i = heapq.heappop(cheapest)[1]
+            selected.append(i)
+            length += price[i].length
 
             if length > self.charge_time_needed:
                 break
 
+        # price is in time order, so sorting the indexes of the selected
+        # slots gives us the slots in time order
+        slots = [price[i] for i in sorted(selected)]
+
         if not len(slots):
             self.log("We don't need any slots...")
             self.status_state = "no slots"
+            self.status_attributes.update(NO_SCHEDULE)
             self.status_attributes["reason"] = "No slots needed"
-            self.status_attributes["next_start"] = ""
-            self.status_attributes["next_stop"] = ""
-            self.status_attributes["slots"] = []
             self.update_status_entity()
             return self.start_charging()
 
-        # Make sure we have the slots in time order
-        slots = sorted(slots, key=lambda i: i["start"])
-
-        self.debug(f"WE NEED THESE SLOTS: {slots} ({length})")
-
-        friendly_slots = []
-        for s in slots:
-            slot = {
-                "start": (
-                    self.get_friendly_date(s["start"])
-                    + " at "
-                    + s["start"].strftime("%H:%M")
-                ),
-                "end": (
-                    self.get_friendly_date(s["end"])
-                    + " at "
-                    + s["end"].strftime("%H:%M")
-                ),
-                "price": s["price"],
+        self.debug("WE NEED THESE SLOTS: %s (%s)", slots, length)
+
+        today = now.date()
+        friendly_slots = [
+            {
+                "start": self.get_friendly_time(s.start, today),
+                "end": self.get_friendly_time(s.end, today),
+                "price": s.price,
             }
-            friendly_slots.append(slot)
+            for s in slots
+        ]
 
         self.status_attributes["slots"] = friendly_slots
 
-        now = self.datetime(aware=True)
         slot = slots[0]
 
         # Try to find the next time charging will stop
-        end_time = slot["start"]
-        for s in slots:
-            if s["start"] != end_time:
+        last = 0
+        for s in slots[1:]:
+            if s.start != slots[last].end:
                 break
 
-            end_time = s["end"]
+            last += 1
 
-        self.status_attributes["next_start"] = (
-            self.get_friendly_date(slot["start"])
-            + " at "
-            + slot["start"].strftime("%H:%M")
-        )
-        self.status_attributes["next_stop"] = (
-            self.get_friendly_date(end_time)
-            + " at "
-            + end_time.strftime("%H:%M")
-        )
+        self.status_attributes["next_start"] = friendly_slots[0]["start"]
+        self.status_attributes["next_stop"] = friendly_slots[last]["end"]
 
-        if slot["start"] < now < slot["end"]:
+        if slot.start < now < slot.end:
             self.start_charging()
             self.status_state = "charging"
         else:
@@ -613,43 +852,47 @@ class SmartCharging(hass.Hass):
 
         self.status_attributes[
             "reason"
-        ] = f"Price now {current_slot['price']:.2f}"
+        ] = f"Price now {current_slot.price:.2f}"
         self.update_status_entity()
         return True
 
-    def convert_time_to_seconds(self, time_str):
-        seconds = 0
-        multipliers = [1, 60, 3600]
-
-        for t in time_str.split(":"):
-            seconds += int(t) * multipliers.pop()
+    @staticmethod
+    def convert_time_to_seconds(time_str):
+        """Convert H[:M[:S]] to seconds"""
+        h, _, rest = time_str.partition(":")
+        m, _, s = rest.partition(":")
 
-        return seconds
+        return int(h) * 3600 + int(m or 0) * 60 + int(s or 0)
 
     def get_config_value(self, param, default):
-        if not param in self.args:
-            return default
-
-        v = self.get_entity_value(self.args[param])
+        if param in self.config_entities:
+            v = self.get_entity_value(self.config_entities[param])
+            return default if v is None else v
 
-        if isinstance(v, str):
-            return v
+        return self.args.get(param, default)
 
+    def get_time_from_config(self, parameter):
+        if parameter in self.config_entities:
+            time = self.get_entity_value(self.config_entities[parameter])
+        elif parameter in self.args:
+            time = self.args[parameter]
         else:
-            return self.args[param]
-
-    def get_time_from_config(self, parameter, in_seconds=True):
-        if not parameter in self.args:
             self.log(f"'{parameter}' not defined in config")
             return None
 
-        time = self.get_state(self.args[parameter])
-        if not time:
-            time = self.args[parameter]
-
         return self.convert_time_to_seconds(time)
 
-    def get_entity_and_attribute(self, name):
+    @staticmethod
+    def is_entity(value):
+        """Check if a config value refers to an entity, i.e. is in the form
+        domain.object_id[,attribute], rather than being a literal value"""
+        return isinstance(value, str) and "." in value.split(",", 1)[0]
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def get_entity_and_attribute(name):
+        """Split entity_id[,attribute] into its parts. The names come from
+        the config and never change, so the result is cached."""
         s = name.split(",")
 
         try:
@@ -660,74 +903,118 @@ class SmartCharging(hass.Hass):
         except Exception:
             return None, None
 
-    def get_price(self):
-        if "price_data" not in self.args:
-            return None
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def parse_datetime(timestamp):
+        """Parse a timestamp from Home Assistant. These are ISO 8601, which
+        fromisoformat handles much faster than the generic dateutil parser,
+        so only fall back to dateutil for anything else. The same timestamps
+        are seen over and over again, so results are cached."""
+        try:
+            return datetime.fromisoformat(timestamp)
+        except ValueError:
+            return parser.parse(timestamp)
 
-        now = self.datetime(aware=True)
-        midnight_today = self.datetime(aware=True).replace(
-            hour=0, minute=0, second=0, microsecond=0
-        )
+    def get_price_slots(self):
+        """Get all price slots from the price entities sorted by start time
 
-        # This is number of seconds from any midnight
-        must_be_done_by = self.get_time_from_config("finish_at_latest_by")
+        Parsing the price info is only done when any of the price entities
+        have been updated, otherwise the result from last time is reused.
 
-        if (
-            must_be_done_by is not None
-            and (now - midnight_today).total_seconds() > must_be_done_by
-        ):
-            # add 24h to the must be done by (since we have passed the time
-            # today already)
-            must_be_done_by += 24 * 3600
-            self.log(f"Required end time already passed. Adding 24 hours.")
+        Returns
+        -------
+        tuple
+            (slots, missing_price_info) where slots is a list of
+            (start, end, start_timestamp, end_timestamp, price) tuples
+        """
+        cache_key = tuple(
+            self.get_state(entity_id=e, attribute="last_updated")
+            for e, a, required in self.price_entities
+        )
 
-        future_prices = []
-        prices = []
+        if cache_key == self.price_cache_key:
+            return self.price_cache
 
+        parts = []
         missing_price_info = False
 
-        # merge all prices (today and tomorrow)
-        for pd in self.args["price_data"]:
-            e, a = self.get_entity_and_attribute(pd["entity"])
+        # Collect and check all prices (today and tomorrow) before merging
+        for e, a, required in self.price_entities:
             part = self.get_state(entity_id=e, attribute=a)
 
             # Mark that we might miss required price info.
             # If we have price info up to the time when we must be finished,
             # then this is overridden
-            if "required" in pd and pd["required"]:
-                if not len(part):
-                    missing_price_info = True
-                    continue
+            if not part:
+                missing_price_info = missing_price_info or required
+                continue
 
-                for p in part:
-                    if "value" not in p or p["value"] is None:
-                        missing_price_info = True
-                        break
+            if required and any(p.get("value") is None for p in part):
+                missing_price_info = True
 
-            prices += part
+            parts.append(part)
 
-        # Sort prices based on start time
-        prices = sorted(prices, key=lambda i: i["start"])
+        # Merge and sort prices based on start time
+        prices = sorted(chain.from_iterable(parts), key=itemgetter("start"))
 
+        slots = []
         for p in prices:
             if p["value"] is None:
                 continue
 
-            start = parser.parse(p["start"])
-            end = parser.parse(p["end"])
-
-            # If end time is in the past, skip it
-            if (end - now).total_seconds() < 0:
-                continue
+            start = self.parse_datetime(p["start"])
+            end = self.parse_datetime(p["end"])
 
-            start_from_midnight_today = int(
-                (start - midnight_today).total_seconds()
+            slots.append(
+                (start, end, start.timestamp(), end.timestamp(), p["value"])
             )
 
-            end_from_midnight_today = int(
-                (end - midnight_today).total_seconds()
+        self.price_cache_key = cache_key
+        self.price_cache = (slots, missing_price_info)
+
+        return self.price_cache
+
+    def get_price(self, now):
+        if "price_data" not in self.args:
+            return None
+
+        midnight_today = now.replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+
+        # Do all time calculations using plain timestamps
+        now_ts = now.timestamp()
+        midnight_ts = midnight_today.timestamp()
+
+        # This is number of seconds from any midnight
+        if self.finish_by_seconds is None:
+            self.finish_by_seconds = self.get_time_from_config(
+                "finish_at_latest_by"
             )
 
+        must_be_done_by = self.finish_by_seconds
+
+        if (
+            must_be_done_by is not None
+            and now_ts - midnight_ts > must_be_done_by
+        ):
+            # add 24h to the must be done by (since we have passed the time
+            # today already)
+            must_be_done_by += 24 * 3600
+            self.log(f"Required end time already passed. Adding 24 hours.")
+
+        future_prices = []
+
+        slots, missing_price_info = self.get_price_slots()
+
+        for start, end, start_ts, end_ts, value in slots:
+            # If end time is in the past, skip it
+            if end_ts < now_ts:
+                continue
+
+            start_from_midnight_today = int(start_ts - midnight_ts)
+            end_from_midnight_today = int(end_ts - midnight_ts)
+
             # If we have price info up to the point when we must
             # be finished with charging, we ignore that we miss
             # required price info.
@@ -739,7 +1026,7 @@ class SmartCharging(hass.Hass):
             ):
                 missing_price_info = False
 
-            seconds_until_start = int((start - now).total_seconds())
+            seconds_until_start = int(start_ts - now_ts)
 
             # If user say we bust have charged before a certain time
             # then don't include times later that that
@@ -758,36 +1045,49 @@ class SmartCharging(hass.Hass):
             ):
                 usable_length = must_be_done_by - start_from_midnight_today
             elif seconds_until_start < 0:
-                usable_length = int((end - start).total_seconds())
+                usable_length = int(end_ts - start_ts)
                 usable_length += seconds_until_start
             else:
-                usable_length = int((end - start).total_seconds())
+                usable_length = int(end_ts - start_ts)
 
             # Store price info in our new parsed format
             future_prices.append(
-                {
-                    "start": start,
-                    "end": end,
-                    "start_from_midnight": start_from_midnight_today,
-                    "end_from_midnight": end_from_midnight_today,
-                    "length": usable_length,
-                    "seconds_until_start": seconds_until_start,
-                    "price": p["value"],
-                }
+                PriceSlot(
+                    start=start,
+                    end=end,
+                    start_from_midnight=start_from_midnight_today,
+                    end_from_midnight=end_from_midnight_today,
+                    length=usable_length,
+                    seconds_until_start=seconds_until_start,
+                    price=value,
+                )
             )
 
         if missing_price_info:
+            # The prices we have don't reach the time when we must be done,
+            # so any schedule based on them would be incomplete
             self.debug("Missing required price info")
+            return None
 
         return future_prices
 
     def update_status_entity(self):
-        entity_id = "sensor." + self.name + "_status"
+        # Attributes are modified in place, so compare a serialized copy
+        status = (
+            self.status_state,
+            json.dumps(self.status_attributes, sort_keys=True, default=str),
+        )
+
+        if status == self.last_status:
+            self.debug("Status is unchanged, skip updating status entity")
+            return
+
+        self.last_status = status
 
-        self.debug(f"Updating status entity with: {self.status_state}")
+        self.debug("Updating status entity with: %s", self.status_state)
 
         self.set_state(
-            entity_id=entity_id,
+            entity_id=self.status_entity_id,
             state=self.status_state,
             attributes=self.status_attributes,
         )